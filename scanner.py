@@ -2,20 +2,40 @@
 # Pre-breakout + threshold scanner with Hot List
 # Runs scheduled (every 5 minutes) under GitHub Actions.
 
-import os, time, json, requests, traceback
+import os, re, time, json, functools, threading, dataclasses, requests, traceback
+import numpy as np
+import orjson
+import pandas as pd
 import yfinance as yf
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ---------------- CONFIG ----------------
 MAX_TICKERS = 1000
 BATCH_SIZE = 50
-RATE_SLEEP = 1.0 # seconds between requests (tune down if you have paid API)
+RATE_SLEEP = 1.0 # seconds between Yahoo download chunks (tune down if you have paid API)
+YF_CHUNK_SIZE = 20 # symbols per batched yf.download request
+COLD_PERIOD = "1mo" # history downloaded for tickers without rolling state
+WARM_PERIOD = "5d" # history downloaded once rolling state is seeded
+MAX_WORKERS = 16 # concurrent Finnhub requests
+FINNHUB_RATE_LIMIT = 60 # Finnhub calls per minute (free tier; raise on paid plans)
 STATE_FILE = "state.json"
+STATE_DIR = "state" # per-ticker state sharded by prefix (alerts_<A..Z>.json, rolling_<A..Z>.json)
+CACHE_DIR = ".cache" # on-disk API response cache (persisted by actions/cache)
+
+# Cache TTLs (seconds) per endpoint
+NEWS_CACHE_TTL = 3600 # headlines
+SENTIMENT_CACHE_TTL = 6 * 3600 # news sentiment
+# Finnhub answers cached as "no data": 429 rate limited, 403 premium-only endpoint
+NEGATIVE_CACHE_STATUSES = (403, 429)
 
 # Leading indicator settings
 GAP_THRESHOLD = 3.0 # percent gap up vs yesterday close
 VOLUME_MULTIPLIER = 2.0 # today volume > multiplier * 30-day avg
 BREAKOUT_LOOKBACK = 20 # days to compute recent high
+AVG_VOL_WINDOW = 30 # bars in the rolling average volume
 SENTIMENT_POSITIVE = 0.2 # minimal bullish sentiment ratio (0-1)
 
 # Percent thresholds (alerts when current intraday change ≥ any of these)
@@ -24,293 +44,811 @@ THRESHOLDS = [5, 10, 20]
 # News window (days) for headlines
 NEWS_WINDOW_DAYS = 2
 
+# Discord message size (content limit is 2000 chars; leave headroom)
+DISCORD_MAX_CHARS = 1900
+DISCORD_MAX_ATTEMPTS = 4 # tries per webhook post when Discord answers 429
+
+# keep yfinance's timezone/cookie cache under CACHE_DIR so it survives between
+# Actions runs (restored by actions/cache) instead of being refetched per symbol
+os.makedirs(os.path.join(CACHE_DIR, "yfinance"), exist_ok=True)
+yf.set_tz_cache_location(os.path.join(CACHE_DIR, "yfinance"))
+
 # ---------------- ENV (from GitHub secrets) ----------------
 FINNHUB_API_KEY = os.environ.get("FINNHUB_API_KEY", "").strip()
 DISCORD_WEBHOOK_URL = os.environ.get("DISCORD_WEBHOOK_URL", "").strip()
 
 if not FINNHUB_API_KEY or not DISCORD_WEBHOOK_URL:
-raise SystemExit("Missing FINNHUB_API_KEY or DISCORD_WEBHOOK_URL in environment variables.")
+    raise SystemExit("Missing FINNHUB_API_KEY or DISCORD_WEBHOOK_URL in environment variables.")
+
+# shared keep-alive HTTP session: every Finnhub/Discord call reuses pooled
+# TCP+TLS connections; transient errors and 429s are retried with backoff
+# (GETs only, so Discord posts are never duplicated)
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=64,
+    # raise_on_status=False: once retries run out the last response is
+    # returned, so callers still see its status code (e.g. a final 429)
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False),
+))
 
 # ---------------- Helpers ----------------
 def now_ts():
-return int(time.time())
+    return int(time.time())
+
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing `rate` calls per `per` seconds.
+    consume() only sleeps when the bucket is empty, so calls go out at full
+    speed while there is headroom.
+    """
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+
+    def consume(self):
+        with self.lock:
+            self._refill()
+            while self.tokens < 1:
+                time.sleep((1 - self.tokens) * self.per / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    def observe(self, remaining):
+        # server says fewer calls are left than we think: shrink the bucket
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, float(remaining))
+
+FINNHUB_BUCKET = TokenBucket(FINNHUB_RATE_LIMIT, 60.0)
+
+def finnhub_get(url, timeout):
+    """GET a Finnhub URL once the rate-limit bucket has a token."""
+    FINNHUB_BUCKET.consume()
+    r = SESSION.get(url, timeout=timeout)
+    remaining = r.headers.get("X-Ratelimit-Remaining")
+    if remaining is not None:
+        try:
+            FINNHUB_BUCKET.observe(int(remaining))
+        except ValueError:
+            pass
+    return r
+
+@dataclasses.dataclass
+class AlertsState:
+    """
+    Alert history stored column-wise: tickers[i], thresholds[i] (set of
+    alerted percent thresholds) and prebreak[i] describe the same ticker,
+    index maps ticker -> i. Saved as three flat arrays per ticker-prefix
+    shard; dirty collects tickers changed since load.
+    """
+    tickers: list = dataclasses.field(default_factory=list)
+    thresholds: list = dataclasses.field(default_factory=list)
+    prebreak: list = dataclasses.field(default_factory=list)
+    index: dict = dataclasses.field(default_factory=dict)
+    dirty: set = dataclasses.field(default_factory=set)
+
+    @classmethod
+    def from_state(cls, data):
+        # also accepts the old {ticker: {"thresholds": [...], "prebreak": bool}} layout
+        if not isinstance(data.get("tickers"), list):
+            data = {
+                "tickers": list(data),
+                "thresholds": [rec.get("thresholds", []) for rec in data.values()],
+                "prebreak": [rec.get("prebreak", False) for rec in data.values()],
+            }
+        alerts = cls(
+            tickers=list(data["tickers"]),
+            thresholds=[set(th) for th in data["thresholds"]],
+            prebreak=list(data["prebreak"]),
+        )
+        alerts.index = {t: i for i, t in enumerate(alerts.tickers)}
+        return alerts
+
+    def shard_state(self, prefix):
+        rows = [i for i, t in enumerate(self.tickers) if t[0] == prefix]
+        return {
+            "tickers": [self.tickers[i] for i in rows],
+            "thresholds": [sorted(self.thresholds[i]) for i in rows],
+            "prebreak": [self.prebreak[i] for i in rows],
+        }
+
+    def _slot(self, ticker):
+        i = self.index.get(ticker)
+        if i is None:
+            i = self.index[ticker] = len(self.tickers)
+            self.tickers.append(ticker)
+            self.thresholds.append(set())
+            self.prebreak.append(False)
+        return i
+
+    def thresholds_for(self, ticker):
+        i = self.index.get(ticker)
+        return self.thresholds[i] if i is not None else set()
+
+    def prebreak_sent(self, ticker):
+        i = self.index.get(ticker)
+        return i is not None and self.prebreak[i]
+
+    def add_threshold(self, ticker, th):
+        self.thresholds[self._slot(ticker)].add(th)
+        self.dirty.add(ticker)
+
+    def set_prebreak(self, ticker):
+        self.prebreak[self._slot(ticker)] = True
+        self.dirty.add(ticker)
 
 def load_state():
-if os.path.exists(STATE_FILE):
-try:
-return json.load(open(STATE_FILE, "r"))
-except Exception:
-return {}
-return {}
+    if os.path.exists(STATE_FILE):
+        try:
+            with open(STATE_FILE, "rb") as f:
+                return orjson.loads(f.read())
+        except Exception:
+            return {}
+    return {}
+
+def write_json_atomic(path, obj):
+    # write to a temp file and rename so a crash never leaves a truncated file
+    with open(path + ".tmp", "wb") as f:
+        f.write(orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS))
+    os.replace(path + ".tmp", path)
 
 def save_state(state):
-try:
-with open(STATE_FILE, "w") as f:
-json.dump(state, f, indent=2)
-except Exception:
-traceback.print_exc()
+    try:
+        write_json_atomic(STATE_FILE, state)
+    except Exception:
+        traceback.print_exc()
+
+def read_shards(kind):
+    """
+    Yields (name, data) for every STATE_DIR/<kind>_<prefix>.json shard;
+    unreadable files are reported and skipped.
+    """
+    if not os.path.isdir(STATE_DIR):
+        return
+    for name in sorted(os.listdir(STATE_DIR)):
+        if not (name.startswith(f"{kind}_") and name.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(STATE_DIR, name), "rb") as f:
+                yield name, orjson.loads(f.read())
+        except Exception:
+            print(f"Skipping unreadable {kind} shard {name}:")
+            traceback.print_exc()
+
+def write_shards(kind, dirty_tickers, build):
+    """
+    Rewrites only the STATE_DIR/<kind>_<prefix>.json shards that hold a
+    ticker changed this run, each with build(prefix); a run that changed
+    nothing writes nothing. Returns True only if every one of them was written.
+    """
+    ok = True
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+    except Exception:
+        traceback.print_exc()
+        return False
+    for prefix in sorted({t[0] for t in dirty_tickers}):
+        try:
+            write_json_atomic(os.path.join(STATE_DIR, f"{kind}_{prefix}.json"), build(prefix))
+        except Exception:
+            print(f"Failed to write {kind} shard {prefix}:")
+            traceback.print_exc()
+            ok = False
+    return ok
+
+def load_alerts(state):
+    """
+    Loads alert history from the alerts_* shards. An old in-state
+    state["alerts_sent"] is merged in and marked dirty so it gets sharded on
+    the next save (main drops it from state.json afterwards).
+    """
+    data = {"tickers": [], "thresholds": [], "prebreak": []}
+    for name, shard in read_shards("alerts"):
+        # the three columns must line up, or every later lookup is off
+        columns = [shard.get(key) for key in data] if isinstance(shard, dict) else [None]
+        if not all(isinstance(c, list) for c in columns) or len({len(c) for c in columns}) != 1:
+            print(f"Skipping malformed alert shard {name}")
+            continue
+        for key, column in zip(data, columns):
+            data[key].extend(column)
+    alerts = AlertsState.from_state(data)
+
+    legacy = state.get("alerts_sent")
+    if legacy:
+        old = AlertsState.from_state(legacy)
+        for t, ths, pre in zip(old.tickers, old.thresholds, old.prebreak):
+            for th in ths:
+                alerts.add_threshold(t, th)
+            if pre:
+                alerts.set_prebreak(t)
+    return alerts
+
+def save_alert_shards(alerts, dirty_tickers):
+    return write_shards("alerts", dirty_tickers, alerts.shard_state)
+
+ROLLING_KEYS = ("vol_window", "vol_sum", "high_deque", "n", "last_date")
+
+def load_rolling(state):
+    """
+    Loads the per-ticker rolling windows (see update_rolling) from the
+    rolling_* shards. Returns (rolling, dirty): an old in-state
+    state["rolling"] is merged under the shards and all its tickers are
+    marked dirty so they get sharded on the next save. Malformed entries are
+    dropped; those tickers are simply reseeded from a full download.
+    """
+    legacy = state.get("rolling") or {}
+    rolling = dict(legacy)
+    for name, shard in read_shards("rolling"):
+        if not isinstance(shard, dict):
+            print(f"Skipping malformed rolling shard {name}")
+            continue
+        rolling.update(shard)
+    rolling = {t: e for t, e in rolling.items() if isinstance(e, dict) and all(k in e for k in ROLLING_KEYS)}
+    return rolling, set(legacy)
+
+def save_rolling_shards(rolling, dirty_tickers):
+    return write_shards("rolling", dirty_tickers, lambda prefix: {t: e for t, e in rolling.items() if t[0] == prefix})
+
+class FetchFailed(Exception):
+    """A Finnhub fetch failed in transport (timeout, 5xx, bad JSON) rather than answering "no data"."""
+
+def cached(endpoint, ttl, default):
+    """
+    Caches the wrapped fetcher's result on disk as
+    CACHE_DIR/<endpoint>/<ticker>.json (ticker = first argument), overwritten
+    on every refetch so there is at most one file per ticker. Each file holds
+    {"ts": epoch, "ttl": seconds, "args": [...], "data": ...} and only counts
+    as a hit for the same arguments within ttl.
+    Empty answers (including 429 / premium-only responses) are cached too,
+    so free-tier endpoints aren't re-hit every run. If the fetcher fails
+    (FetchFailed or any other error) `default` is returned and nothing is
+    cached, so a network blip doesn't hide data for a whole TTL.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args):
+            path = os.path.join(CACHE_DIR, endpoint, f"{args[0]}.json")
+            try:
+                with open(path, "r") as f:
+                    entry = json.load(f)
+                if entry["args"] == list(args) and time.time() - entry["ts"] <= entry["ttl"]:
+                    return entry["data"]
+            except Exception:
+                pass
+            try:
+                data = fn(*args)
+            except FetchFailed:
+                return default
+            except Exception:
+                print(f"[{args[0]}] {endpoint} fetch exception:")
+                traceback.print_exc()
+                return default
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + ".tmp", "w") as f:
+                    json.dump({"ts": time.time(), "ttl": ttl, "args": list(args), "data": data}, f)
+                os.replace(path + ".tmp", path)
+            except Exception:
+                traceback.print_exc()
+            return data
+        return wrapper
+    return decorator
+
+def prune_cache(max_age):
+    """
+    Deletes cached Finnhub responses not rewritten for max_age seconds
+    (delisted tickers, files from older key layouts), so the .cache that
+    actions/cache restores and saves every run stays bounded.
+    """
+    cutoff = time.time() - max_age
+    for dirpath, _, names in os.walk(os.path.join(CACHE_DIR, "finnhub")):
+        for name in names:
+            path = os.path.join(dirpath, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+# plain tickers only: letters, digits and class dashes (skips spaces/slashes/dots)
+_VALID_SYMBOL = re.compile(r"^[A-Z0-9-]{1,8}$").match
 
 def get_tickers(state):
-tickers = state.get("tickers")
-fetched_at = state.get("tickers_fetched_at", 0)
-if tickers and (now_ts() - fetched_at) < 24 * 3600:
-return tickers
-url = f"https://finnhub.io/api/v1/stock/symbol?exchange=US&token={FINNHUB_API_KEY}"
-r = requests.get(url, timeout=20)
-r.raise_for_status()
-data = r.json()
-extracted = []
-for s in data:
-sym = s.get("symbol")
-if not sym or not isinstance(sym, str):
-continue
-# basic sanitation: skip weird tickers with spaces/slashes/dots
-su = sym.strip().upper()
-if " " in su or "/" in su or "." in su:
-continue
-extracted.append(su)
-if not extracted:
-raise SystemExit("No tickers returned from Finnhub symbol endpoint.")
-tickers = extracted[:MAX_TICKERS]
-state["tickers"] = tickers
-state["tickers_fetched_at"] = now_ts()
-save_state(state)
-return tickers
+    tickers = state.get("tickers")
+    fetched_at = state.get("tickers_fetched_at", 0)
+    if tickers and (now_ts() - fetched_at) < 24 * 3600:
+        return tickers
+    url = f"https://finnhub.io/api/v1/stock/symbol?exchange=US&token={FINNHUB_API_KEY}"
+    r = finnhub_get(url, timeout=20)
+    r.raise_for_status()
+    data = r.json()
+    extracted = [
+        su for s in data
+        if isinstance(sym := s.get("symbol"), str) and _VALID_SYMBOL(su := sym.strip().upper())
+    ]
+    if not extracted:
+        raise SystemExit("No tickers returned from Finnhub symbol endpoint.")
+    tickers = extracted[:MAX_TICKERS]
+    state["tickers"] = tickers
+    state["tickers_fetched_at"] = now_ts()
+    save_state(state)
+    return tickers
 
 def batches_for_run(tickers):
-if not tickers:
-return [], 0, 0
-slot = int(time.time() // 300) # 5-minute window slot
-batches = [tickers[i:i+BATCH_SIZE] for i in range(0, len(tickers), BATCH_SIZE)]
-idx = slot % len(batches)
-return batches[idx], idx, len(batches)
-
-def fetch_news_headlines(ticker):
-to_date = datetime.utcnow().date()
-from_date = (datetime.utcnow() - timedelta(days=NEWS_WINDOW_DAYS)).date()
-url = f"https://finnhub.io/api/v1/company-news?symbol={ticker}&from={from_date}&to={to_date}&token={FINNHUB_API_KEY}"
-try:
-r = requests.get(url, timeout=8)
-if r.status_code != 200:
-return []
-data = r.json()
-if not isinstance(data, list):
-return []
-return data[:3]
-except Exception:
-return []
-
+    if not tickers:
+        return [], 0, 0
+    slot = int(time.time() // 300) # 5-minute window slot
+    batches = [tickers[i:i+BATCH_SIZE] for i in range(0, len(tickers), BATCH_SIZE)]
+    idx = slot % len(batches)
+    return batches[idx], idx, len(batches)
+
+def fetch_history(groups):
+    """
+    Downloads daily bars using batched yf.download calls of YF_CHUNK_SIZE
+    symbols each. groups maps a yf period ("1mo", "5d") to the tickers to
+    download with it. Returns one DataFrame with (ticker, field) MultiIndex
+    columns, or None if Yahoo returned nothing.
+    """
+    frames = []
+    chunks = [(tickers[i:i+YF_CHUNK_SIZE], period)
+              for period, tickers in groups.items()
+              for i in range(0, len(tickers), YF_CHUNK_SIZE)]
+    for n, (chunk, period) in enumerate(chunks):
+        if n:
+            # throttle between chunks only (Tune RATE_SLEEP based on your limits)
+            time.sleep(RATE_SLEEP)
+        try:
+            df = yf.download(
+                tickers=" ".join(chunk),
+                period=period,
+                interval="1d",
+                group_by="ticker",
+                threads=True,
+                auto_adjust=False,
+                progress=False,
+            )
+        except Exception:
+            print(f"yf.download exception for chunk {n+1}/{len(chunks)}:")
+            traceback.print_exc()
+            continue
+        if df is None or df.empty:
+            continue
+        if not isinstance(df.columns, pd.MultiIndex):
+            df.columns = pd.MultiIndex.from_product([chunk, df.columns])
+        frames.append(df)
+    if not frames:
+        return None
+    return pd.concat(frames, axis=1).sort_index()
+
+def update_rolling(rolling, hist, tickers):
+    """
+    Pushes completed daily bars (each ticker's bars before its own latest
+    one, which is "today") newer than its last_date into its rolling state,
+    so the 30-bar average volume and 20-day high never need the full window
+    re-downloaded. Returns the tickers whose state changed. Per ticker:
+    - 'vol_window' / 'vol_sum': last AVG_VOL_WINDOW volumes and their sum
+    - 'high_deque': monotonic-decreasing [bar_no, high] pairs over the last
+      BREAKOUT_LOOKBACK bars; the front is always the window max
+    - 'n': completed bars seen, 'last_date': date of the newest one
+    """
+    changed = set()
+    all_dates = [d.strftime("%Y-%m-%d") for d in hist.index]
+    downloaded = set(hist.columns.get_level_values(0))
+    for ticker in tickers:
+        if ticker not in downloaded:
+            continue
+        entry = rolling.setdefault(ticker, {"vol_window": [], "vol_sum": 0, "high_deque": [], "n": 0, "last_date": ""})
+        # same "today" as compute_signals: the ticker's last non-NaN close
+        rows = np.flatnonzero(~np.isnan(hist[(ticker, "Close")].to_numpy(dtype=float)))[:-1]
+        highs = hist[(ticker, "High")].to_numpy(dtype=float)[rows]
+        vols = hist[(ticker, "Volume")].to_numpy(dtype=float)[rows]
+        dates = [all_dates[i] for i in rows]
+        for date, high, vol in zip(dates, highs, vols):
+            if date <= entry["last_date"] or np.isnan(high) or np.isnan(vol):
+                continue
+            window = entry["vol_window"]
+            window.append(int(vol))
+            entry["vol_sum"] += int(vol)
+            if len(window) > AVG_VOL_WINDOW:
+                entry["vol_sum"] -= window.pop(0)
+
+            entry["n"] += 1
+            dq = entry["high_deque"]
+            while dq and dq[-1][1] <= high:
+                dq.pop()
+            dq.append([entry["n"], float(high)])
+            if dq[0][0] <= entry["n"] - BREAKOUT_LOOKBACK:
+                dq.pop(0)
+            entry["last_date"] = date
+            changed.add(ticker)
+    return changed
+
+def screen(price, prev_close, open_price, vol, avg_vol, high20, valid, gap_thr, vol_mul, thresholds):
+    """
+    Screening kernel over (tickers,) float arrays. Returns
+    (change_pct, gap_pct, gap_mask, vol_mask, breakout_mask, thresh_idx) where
+    thresh_idx[i] is how many of the ascending `thresholds` ticker i's change
+    has reached. Invalid tickers (valid False) never match anything.
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        change_pct = (price - prev_close) / prev_close * 100.0
+        gap_pct = (open_price - prev_close) / prev_close * 100.0
+        gap_mask = valid & (gap_pct >= gap_thr)
+        vol_mask = valid & (avg_vol > 0) & (vol > vol_mul * avg_vol)
+        breakout_mask = valid & ~np.isnan(high20) & (price > high20)
+    thresh_idx = np.where(valid, np.searchsorted(thresholds, np.nan_to_num(change_pct), side="right"), 0)
+    return change_pct, gap_pct, gap_mask, vol_mask, breakout_mask, thresh_idx
+
+def compute_signals(hist, tickers, rolling):
+    """
+    Vectorized indicator pass over the batched download: today's and
+    yesterday's bars are (tickers,) ndarrays, average volume and 20-day high
+    come from the rolling state, and screen() evaluates every trigger across
+    all tickers at once. Returns {name: ndarray} aligned with tickers;
+    'candidate' marks tickers that can possibly alert (any leading trigger
+    or a threshold move).
+    """
+    def field(name):
+        return hist.xs(name, axis=1, level=1).reindex(columns=tickers).to_numpy(dtype=float)
+
+    entries = [rolling.get(t) or {"vol_window": [], "vol_sum": 0, "high_deque": [], "n": 0} for t in tickers]
+    n_bars = np.array([e["n"] for e in entries])
+    vol_sum = np.array([e["vol_sum"] for e in entries], dtype=float)
+    window_len = np.array([len(e["vol_window"]) for e in entries])
+    oldest_vol = np.array([e["vol_window"][0] if e["vol_window"] else 0 for e in entries], dtype=float)
+    high20 = np.array([e["high_deque"][0][1] if e["n"] >= BREAKOUT_LOOKBACK else np.nan for e in entries])
+
+    closes, opens, vols = field("Close"), field("Open"), field("Volume")
+    # today / yesterday are each ticker's own last two bars: in the merged
+    # frame a thin name can have NaN rows where other tickers traded
+    cols = np.arange(closes.shape[1])
+    has_bar = ~np.isnan(closes)
+    last = len(closes) - 1 - np.argmax(has_bar[::-1], axis=0)
+    has_bar[last, cols] = False
+    prev = len(closes) - 1 - np.argmax(has_bar[::-1], axis=0)
+    has_prev = has_bar.any(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        price = closes[last, cols]
+        prev_close = np.where(has_prev, closes[prev, cols], np.nan)
+        open_price = np.where(np.isnan(opens[last, cols]), price, opens[last, cols])
+        vol = np.nan_to_num(vols[last, cols])
+        # average volume over the last AVG_VOL_WINDOW bars (today included)
+        full = window_len >= AVG_VOL_WINDOW
+        avg_vol = np.trunc(np.where(full, (vol_sum - oldest_vol + vol) / AVG_VOL_WINDOW, (vol_sum + vol) / (window_len + 1)))
+
+        valid = (n_bars >= 2) & (prev_close > 0) & ~np.isnan(price)
+
+    change_pct, gap_pct, gap, unusual_vol, breakout, thresh_idx = screen(
+        price, prev_close, open_price, vol, avg_vol, high20, valid,
+        GAP_THRESHOLD, VOLUME_MULTIPLIER, np.array(sorted(THRESHOLDS), dtype=float),
+    )
+    candidate = gap | unusual_vol | breakout | (thresh_idx > 0)
+
+    return {
+        "price": price,
+        "change_pct": change_pct,
+        "gap_pct": gap_pct,
+        "vol": vol,
+        "avg_vol": avg_vol,
+        "high20": high20,
+        "gap": gap,
+        "unusual_vol": unusual_vol,
+        "breakout": breakout,
+        "thresh_idx": thresh_idx,
+        "candidate": candidate,
+    }
+
+def finnhub_json(url):
+    """
+    GETs a Finnhub URL and returns its JSON, or None for a "no data" status
+    (NEGATIVE_CACHE_STATUSES). Raises FetchFailed on transport errors, other
+    non-200 responses and unparseable bodies.
+    """
+    try:
+        r = finnhub_get(url, timeout=8)
+    except requests.RequestException as e:
+        raise FetchFailed(str(e)) from e
+    if r.status_code in NEGATIVE_CACHE_STATUSES:
+        return None
+    if r.status_code != 200:
+        raise FetchFailed(f"HTTP {r.status_code}")
+    try:
+        return r.json()
+    except ValueError as e:
+        raise FetchFailed("invalid JSON") from e
+
+@cached("finnhub/news", NEWS_CACHE_TTL, default=[])
+def fetch_news_headlines(ticker, from_date, to_date):
+    url = f"https://finnhub.io/api/v1/company-news?symbol={ticker}&from={from_date}&to={to_date}&token={FINNHUB_API_KEY}"
+    data = finnhub_json(url)
+    if not isinstance(data, list):
+        return []
+    return data[:3]
+
+@cached("finnhub/sentiment", SENTIMENT_CACHE_TTL, default=None)
 def fetch_news_sentiment(ticker):
-# Finnhub news-sentiment endpoint (may be limited on free tier)
-url = f"https://finnhub.io/api/v1/news-sentiment?symbol={ticker}&token={FINNHUB_API_KEY}"
-try:
-r = requests.get(url, timeout=8)
-if r.status_code != 200:
-return None
-data = r.json()
-# Try common keys: 'sentiment' -> 'bullishPercent' sometimes present
-s = data.get("sentiment") if isinstance(data, dict) else None
-if isinstance(s, dict):
-bp = s.get("bullishPercent")
-if bp is not None:
-try:
-return float(bp) / 100.0
-except:
-pass
-# fallback: return None if not present
-return None
-except Exception:
-return None
-
-def send_discord(subject, body):
-payload = {"content": f"**{subject}**\n```{body[:1900]}```"}
-try:
-r = requests.post(DISCORD_WEBHOOK_URL, json=payload, timeout=10)
-print(f"[Discord] {r.status_code} - {subject}")
-if r.status_code not in (200, 204):
-print("Discord response:", r.text[:300])
-return r.status_code in (200, 204)
-except Exception:
-print("Discord send exception:")
-traceback.print_exc()
-return False
+    # Finnhub news-sentiment endpoint (may be limited on free tier)
+    url = f"https://finnhub.io/api/v1/news-sentiment?symbol={ticker}&token={FINNHUB_API_KEY}"
+    data = finnhub_json(url)
+    # Try common keys: 'sentiment' -> 'bullishPercent' sometimes present
+    s = data.get("sentiment") if isinstance(data, dict) else None
+    if isinstance(s, dict):
+        bp = s.get("bullishPercent")
+        if bp is not None:
+            try:
+                return float(bp) / 100.0
+            except (TypeError, ValueError):
+                pass
+    # fallback: return None if not present
+    return None
+
+def fetch_concurrently(fn, tickers, *args):
+    """
+    Runs fn(ticker, *args) for every ticker on a thread pool and returns
+    {ticker: result}. fn is expected to handle its own errors (the @cached
+    fetch_news_* never raise). This pool is the scanner's only I/O concurrency: yfinance
+    is synchronous, so there is deliberately no asyncio/aiohttp event loop.
+    """
+    if not tickers:
+        return {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        futures = {ex.submit(fn, t, *args): t for t in tickers}
+        return {futures[f]: f.result() for f in futures}
+
+def send_discord(messages):
+    """
+    Posts a run's alerts as few webhook messages as possible: each
+    {"subject", "body", ...} becomes a bold subject + code block, and these
+    are packed into posts of at most DISCORD_MAX_CHARS. A 429 is retried
+    after Discord's retry_after. Returns the messages whose post was
+    delivered, so only those get recorded as sent.
+    """
+    chunks = [] # [content, [messages]]
+    for m in messages:
+        room = DISCORD_MAX_CHARS - len(m["subject"]) - 12 # "**", newline, fences
+        part = f"**{m['subject']}**\n```{m['body'][:room]}```"
+        if chunks and len(chunks[-1][0]) + 1 + len(part) <= DISCORD_MAX_CHARS:
+            chunks[-1][0] += "\n" + part
+            chunks[-1][1].append(m)
+        else:
+            chunks.append([part, [m]])
+
+    delivered = []
+    for n, (content, chunk_messages) in enumerate(chunks):
+        for attempt in range(DISCORD_MAX_ATTEMPTS):
+            try:
+                r = SESSION.post(DISCORD_WEBHOOK_URL, json={"content": content}, timeout=10)
+            except Exception:
+                print("Discord send exception:")
+                traceback.print_exc()
+                break
+            print(f"[Discord] {r.status_code} - message {n+1}/{len(chunks)}")
+            if r.status_code in (200, 204):
+                delivered.extend(chunk_messages)
+                break
+            if r.status_code != 429:
+                print("Discord response:", r.text[:300])
+                break
+            # webhook rate limit: wait as long as Discord asks, then retry
+            try:
+                wait = float(r.json().get("retry_after"))
+            except Exception:
+                wait = float(r.headers.get("Retry-After", 1.0))
+            time.sleep(wait)
+    return delivered
 
 # ---------------- Scanning logic ----------------
-def analyze_ticker(ticker, alerts_sent):
-"""
-Returns dict of findings or None.
-findings contains keys:
-- 'type': 'prebreak' or 'threshold'
-- 'triggers': list of trigger descriptions
-- 'price', 'change_pct', 'vol', 'avg_vol'
-"""
-try:
-# Use yfinance daily history 1 month
-t = yf.Ticker(ticker)
-hist = t.history(period="1mo", interval="1d", auto_adjust=False)
-if hist is None or hist.empty or len(hist) < 3:
-return None
-
-today = hist.iloc[-1]
-yesterday = hist.iloc[-2]
-price = float(today.get("Close", 0) or 0.0)
-prev_close = float(yesterday.get("Close", 0) or 0.0)
-open_price = float(today.get("Open", price) or price)
-vol_today = int(today.get("Volume", 0) or 0)
-
-if prev_close <= 0:
-return None
-
-change_pct = (price - prev_close) / prev_close * 100.0
-
-# average volume: use previous 30 calendar days if available
-vol_series = hist["Volume"].dropna()
-avg_vol = int(vol_series.tail(30).mean()) if len(vol_series) >= 5 else int(vol_series.mean() if len(vol_series) else 0)
-
-unusual_vol = avg_vol > 0 and (vol_today > (VOLUME_MULTIPLIER * avg_vol))
-
-# breakout check: price > recent N-day high (exclude today when computing)
-high20 = None
-if len(hist) >= BREAKOUT_LOOKBACK + 1:
-high20 = float(hist["High"].shift(1).tail(BREAKOUT_LOOKBACK).max())
-breakout = high20 is not None and (price > high20)
-
-# news sentiment (if available)
-sentiment = fetch_news_sentiment(ticker)
-pos_news = sentiment is not None and sentiment >= SENTIMENT_POSITIVE
-
-# build triggers
-triggers = []
-if (open_price - prev_close) / prev_close * 100.0 >= GAP_THRESHOLD:
-triggers.append(f"Gap +{(open_price - prev_close) / prev_close * 100.0:.1f}%")
-if unusual_vol:
-triggers.append(f"UnusualVol {vol_today:,} (avg {avg_vol:,})")
-if breakout and high20 is not None:
-triggers.append(f"Breakout 20d > {high20:.2f}")
-if pos_news:
-triggers.append(f"PositiveSentiment {sentiment:.2f}")
-
-# Check percent thresholds that haven't been alerted for this ticker
-new_thresholds = []
-prev_thresholds = set(alerts_sent.get(ticker, {}).get("thresholds", []))
-for th in THRESHOLDS:
-if change_pct >= th and th not in prev_thresholds:
-new_thresholds.append(th)
-
-result = {
-"ticker": ticker,
-"price": price,
-"change_pct": change_pct,
-"vol": vol_today,
-"avg_vol": avg_vol,
-"triggers": triggers,
-"new_thresholds": new_thresholds,
-"pos_news": pos_news,
-"sentiment": sentiment
-}
-
-# decide whether to return signals:
-# - threshold signal if any new_thresholds exist
-# - prebreak signal if len(triggers) >= 2 and prebreak not previously alerted
-prebreak_already = alerts_sent.get(ticker, {}).get("prebreak", False)
-prebreak_hit = (len(triggers) >= 2) and (not prebreak_already)
-
-if new_thresholds or prebreak_hit:
-result["prebreak_hit"] = prebreak_hit
-return result
-return None
-
-except Exception:
-print(f"[{ticker}] analyze exception:")
-traceback.print_exc()
-return None
+def analyze_ticker(ticker, row, sentiment, alerts_sent):
+    """
+    Returns dict of findings or None.
+    row holds the ticker's values from compute_signals,
+    sentiment its prefetched fetch_news_sentiment value.
+    findings contains keys:
+    - 'type': 'prebreak' or 'threshold'
+    - 'triggers': list of trigger descriptions
+    - 'price', 'change_pct', 'vol', 'avg_vol'
+    """
+    try:
+        price = float(row["price"])
+        change_pct = float(row["change_pct"])
+        vol_today = int(row["vol"])
+        avg_vol = int(row["avg_vol"])
+
+        # news sentiment (if available)
+        pos_news = sentiment is not None and sentiment >= SENTIMENT_POSITIVE
+
+        # build triggers
+        triggers = []
+        if row["gap"]:
+            triggers.append(f"Gap +{row['gap_pct']:.1f}%")
+        if row["unusual_vol"]:
+            triggers.append(f"UnusualVol {vol_today:,} (avg {avg_vol:,})")
+        if row["breakout"]:
+            triggers.append(f"Breakout 20d > {row['high20']:.2f}")
+        if pos_news:
+            triggers.append(f"PositiveSentiment {sentiment:.2f}")
+
+        # Check percent thresholds that haven't been alerted for this ticker
+        new_thresholds = []
+        prev_thresholds = alerts_sent.thresholds_for(ticker)
+        for th in sorted(THRESHOLDS)[:row["thresh_idx"]]:
+            if th not in prev_thresholds:
+                new_thresholds.append(th)
+
+        result = {
+            "ticker": ticker,
+            "price": price,
+            "change_pct": change_pct,
+            "vol": vol_today,
+            "avg_vol": avg_vol,
+            "triggers": triggers,
+            "new_thresholds": new_thresholds,
+            "pos_news": pos_news,
+            "sentiment": sentiment
+        }
+
+        # decide whether to return signals:
+        # - threshold signal if any new_thresholds exist
+        # - prebreak signal if len(triggers) >= 2 and prebreak not previously alerted
+        prebreak_already = alerts_sent.prebreak_sent(ticker)
+        prebreak_hit = (len(triggers) >= 2) and (not prebreak_already)
+
+        if new_thresholds or prebreak_hit:
+            result["prebreak_hit"] = prebreak_hit
+            return result
+        return None
+
+    except Exception:
+        print(f"[{ticker}] analyze exception:")
+        traceback.print_exc()
+        return None
 
 # ---------------- Main ----------------
 def main():
-state = load_state()
-alerts_sent = state.get("alerts_sent", {}) # mapping ticker -> {"thresholds":[...], "prebreak":bool}
-hot_list = set(state.get("hot_list", []))
-
-tickers = get_tickers(state)
-batch, idx, total = batches_for_run(tickers)
-if not batch:
-print("No batch to scan.")
-return
-
-# Scan both current batch + hot list
-scan_set = list(dict.fromkeys(batch + list(hot_list))) # preserve order, avoid duplicates
-print(f"{datetime.utcnow().isoformat()} | Scanning {len(scan_set)} tickers (batch {idx+1}/{total}), hotlist size={len(hot_list)}")
-
-alerts_this_run = []
-
-for ticker in scan_set:
-try:
-res = analyze_ticker(ticker, alerts_sent)
-# short sleep to avoid bursting API (Tune RATE_SLEEP based on your limits)
-time.sleep(RATE_SLEEP)
-if not res:
-continue
-
-# handle threshold alerts
-if res["new_thresholds"]:
-# record thresholds in state
-rec = alerts_sent.setdefault(ticker, {})
-rec_thresholds = set(rec.get("thresholds", []))
-for th in res["new_thresholds"]:
-rec_thresholds.add(th)
-subject = f"🚀 {ticker} +{res['change_pct']:.1f}% | Threshold +{th}%"
-news = fetch_news_headlines(ticker)
-headlines = "\n".join([f"- {n.get('headline','')[:200]} ({n.get('source','')})" for n in news]) or "No recent news."
-body = (
-f"Price: {res['price']:.2f} (Prev close → change {res['change_pct']:.1f}%)\n"
-f"Volume: {res['vol']:,} (avg {res['avg_vol']:,})\n\n"
-f"Recent News:\n{headlines}\n\n"
-f"Time (UTC): {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}\n"
-"⚠️ Not financial advice."
-)
-send_discord(subject, body)
-alerts_this_run.append((ticker, f"threshold +{th}%"))
-rec["thresholds"] = sorted(list(rec_thresholds))
-alerts_sent[ticker] = rec
-# add to hot list to monitor continuously
-hot_list.add(ticker)
-
-# handle pre-breakout alerts
-if res.get("prebreak_hit"):
-rec = alerts_sent.setdefault(ticker, {})
-if not rec.get("prebreak"):
-rec["prebreak"] = True
-subject = f"⚡ PRE-BREAKOUT: {ticker} — {', '.join(res['triggers'])} | {res['change_pct']:.1f}%"
-news = fetch_news_headlines(ticker)
-headlines = "\n".join([f"- {n.get('headline','')[:200]} ({n.get('source','')})" for n in news]) or "No recent news."
-body = (
-f"Price: {res['price']:.2f} (change {res['change_pct']:.1f}%)\n"
-f"Triggers: {', '.join(res['triggers'])}\n"
-f"Volume: {res['vol']:,} (avg {res['avg_vol']:,})\n\n"
-f"Recent News:\n{headlines}\n\n"
-f"Time (UTC): {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}\n"
-"⚠️ Possible pre-breakout signal — verify before trading."
-)
-send_discord(subject, body)
-alerts_this_run.append((ticker, "prebreak"))
-hot_list.add(ticker)
-
-except Exception:
-print(f"Exception during scan of {ticker}:")
-traceback.print_exc()
-
-# persist state for next run
-state["alerts_sent"] = alerts_sent
-state["hot_list"] = list(hot_list)
-state["tickers"] = tickers
-state["tickers_fetched_at"] = state.get("tickers_fetched_at", now_ts())
-state["last_run"] = now_ts()
-save_state(state)
-
-print(f"Done. Alerts this run: {len(alerts_this_run)}")
-if alerts_this_run:
-for a in alerts_this_run:
-print("Alerted:", a)
+    prune_cache(max(NEWS_CACHE_TTL, SENTIMENT_CACHE_TTL))
+    state = load_state()
+    alerts_sent = load_alerts(state)
+    hot_list = set(state.get("hot_list", []))
+
+    tickers = get_tickers(state)
+    batch, idx, total = batches_for_run(tickers)
+    if not batch:
+        print("No batch to scan.")
+        return
+
+    # Scan both current batch + hot list
+    batch_set = set(batch)
+    if hot_list <= batch_set:
+        scan_set = batch
+    else:
+        scan_set = batch + [t for t in hot_list if t not in batch_set] # batch order, no duplicates
+    # one clock read per run, reused for logs, news window and alert bodies
+    run_utc = datetime.utcnow()
+    run_utc_str = run_utc.strftime('%Y-%m-%d %H:%M:%S')
+    news_from = (run_utc - timedelta(days=NEWS_WINDOW_DAYS)).date().isoformat()
+    news_to = run_utc.date().isoformat()
+
+    print(f"{run_utc.isoformat()} | Scanning {len(scan_set)} tickers (batch {idx+1}/{total}), hotlist size={len(hot_list)}")
+
+    # tickers whose rolling state is recent only need the last few bars;
+    # stale or missing state is reseeded from a full month
+    rolling, rolling_dirty = load_rolling(state)
+    cutoff = (run_utc - timedelta(days=7)).strftime("%Y-%m-%d")
+    warm, cold = [], []
+    for t in scan_set:
+        if rolling.get(t, {}).get("last_date", "") >= cutoff:
+            warm.append(t)
+        else:
+            if rolling.pop(t, None) is not None:
+                rolling_dirty.add(t)
+            cold.append(t)
+
+    # one batched Yahoo download for the whole scan set
+    hist = fetch_history({WARM_PERIOD: warm, COLD_PERIOD: cold})
+
+    results = {}
+    if hist is not None:
+        rolling_dirty |= update_rolling(rolling, hist, scan_set)
+        signals = compute_signals(hist, scan_set, rolling)
+        # sentiment is only ever a second pre-breakout trigger, so it is
+        # fetched (in parallel) just for tickers where a price/volume trigger
+        # already fired and pre-breakout hasn't been alerted yet
+        leading = signals["gap"] | signals["unusual_vol"] | signals["breakout"]
+        sentiments = fetch_concurrently(fetch_news_sentiment, [
+            scan_set[i] for i in np.flatnonzero(leading)
+            if not alerts_sent.prebreak_sent(scan_set[i])
+        ])
+        # only tickers where some trigger or threshold fired can alert
+        for i in np.flatnonzero(signals["candidate"]):
+            ticker = scan_set[i]
+            row = {k: v[i] for k, v in signals.items()}
+            res = analyze_ticker(ticker, row, sentiments.get(ticker), alerts_sent)
+            if res:
+                results[ticker] = res
+    # headlines only for tickers that will alert, again in parallel
+    news_by_ticker = fetch_concurrently(fetch_news_headlines, list(results), news_from, news_to)
+
+    messages = [] # sent together once the scan is done
+
+    for ticker, res in results.items():
+        try:
+            news = news_by_ticker.get(ticker, [])
+            headlines = "\n".join([f"- {n.get('headline','')[:200]} ({n.get('source','')})" for n in news]) or "No recent news."
+
+            # handle threshold alerts
+            if res["new_thresholds"]:
+                for th in res["new_thresholds"]:
+                    subject = f"🚀 {ticker} +{res['change_pct']:.1f}% | Threshold +{th}%"
+                    body = (
+                        f"Price: {res['price']:.2f} (Prev close → change {res['change_pct']:.1f}%)\n"
+                        f"Volume: {res['vol']:,} (avg {res['avg_vol']:,})\n\n"
+                        f"Recent News:\n{headlines}\n\n"
+                        f"Time (UTC): {run_utc_str}\n"
+                        "⚠️ Not financial advice."
+                    )
+                    messages.append({"subject": subject, "body": body, "ticker": ticker, "threshold": th})
+                # add to hot list to monitor continuously
+                hot_list.add(ticker)
+
+            # handle pre-breakout alerts
+            if res.get("prebreak_hit"):
+                if not alerts_sent.prebreak_sent(ticker):
+                    subject = f"⚡ PRE-BREAKOUT: {ticker} — {', '.join(res['triggers'])} | {res['change_pct']:.1f}%"
+                    body = (
+                        f"Price: {res['price']:.2f} (change {res['change_pct']:.1f}%)\n"
+                        f"Triggers: {', '.join(res['triggers'])}\n"
+                        f"Volume: {res['vol']:,} (avg {res['avg_vol']:,})\n\n"
+                        f"Recent News:\n{headlines}\n\n"
+                        f"Time (UTC): {run_utc_str}\n"
+                        "⚠️ Possible pre-breakout signal — verify before trading."
+                    )
+                    messages.append({"subject": subject, "body": body, "ticker": ticker, "threshold": None})
+                    hot_list.add(ticker)
+
+        except Exception:
+            print(f"Exception during scan of {ticker}:")
+            traceback.print_exc()
+
+    # record alerts in state only once Discord has them; undelivered ones
+    # stay unrecorded and fire again next run
+    alerts_this_run = []
+    for m in send_discord(messages) if messages else []:
+        if m["threshold"] is None:
+            alerts_sent.set_prebreak(m["ticker"])
+            alerts_this_run.append((m["ticker"], "prebreak"))
+        else:
+            alerts_sent.add_threshold(m["ticker"], m["threshold"])
+            alerts_this_run.append((m["ticker"], f"threshold +{m['threshold']}%"))
+    if len(alerts_this_run) < len(messages):
+        print(f"Undelivered alerts (retried next run): {len(messages) - len(alerts_this_run)}")
+
+    # persist state for next run
+    # only drop the old in-state history once it is safely in the shards
+    if save_alert_shards(alerts_sent, alerts_sent.dirty):
+        state.pop("alerts_sent", None)
+    state["hot_list"] = list(hot_list)
+    # rolling windows only change when a ticker gets a new completed bar
+    # (first scan of it each trading day), so most runs write no shard
+    if save_rolling_shards(rolling, rolling_dirty):
+        state.pop("rolling", None)
+    state["tickers"] = tickers
+    state["tickers_fetched_at"] = state.get("tickers_fetched_at", now_ts())
+    state["last_run"] = now_ts()
+    save_state(state)
+
+    print(f"Done. Alerts this run: {len(alerts_this_run)}")
+    if alerts_this_run:
+        for a in alerts_this_run:
+            print("Alerted:", a)
 
 if __name__ == "__main__":
-main()
+    main()